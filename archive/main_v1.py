@@ -10,7 +10,6 @@ import os
 import logging
 import pandas as pd
 
-from time import sleep
 from datetime import datetime
 from configparser import ConfigParser
 
@@ -21,32 +20,49 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 OUTPUT_EXCEL_NAME = f"Building_Dwellings_Summarized_{TODAY}.xlsx"
 
-# Config Settings from .ini file
-parser = ConfigParser()
-parser.read("settings.ini")
-settings = parser['settings']
-
-SDE = settings.get("SDE")
-
-# FEATURES
-BUILDING_POLYGONS_FEATURE = os.path.join(SDE, "SDEADM.BLD_building_polygon")
-WASTE_COLLECTION_AREAS_FEATURE = os.path.join(SDE, "SDEADM.ADM_solid_waste", "SDEADM.ADM_waste_coll_area")
-BUILDING_USE_TABLE = os.path.join(SDE, "SDEADM.BLD_BUILDING_USE")
-
 # Logger Settings
 LOG_FILE = f"logs_{TODAY}.log"
 
-logger = logging.getLogger("__name__")
-level = logging.DEBUG
-logger.setLevel(level)
+logger = logging.getLogger(__name__)
 
 FORMATTER = logging.Formatter(
     '%(asctime)s | %(levelname)s | FUNCTION: %(funcName)s | Msgs: %(message)s', datefmt='%d-%b-%y %H:%M:%S'
 )
 
-handler = logging.FileHandler(LOG_FILE)
-handler.setFormatter(FORMATTER)
-logger.addHandler(handler)
+# FEATURES - set from the .ini file by _configure()
+BUILDING_POLYGONS_FEATURE = None
+WASTE_COLLECTION_AREAS_FEATURE = None
+BUILDING_USE_TABLE = None
+
+
+def _configure():
+    """
+    - Read settings from the .ini file and add the log file handler
+    - Called by dwelling_units(), so importing the module has no side effects. Only runs once
+    """
+
+    global BUILDING_POLYGONS_FEATURE, WASTE_COLLECTION_AREAS_FEATURE, BUILDING_USE_TABLE
+
+    if BUILDING_POLYGONS_FEATURE is not None:
+        return
+
+    # Config Settings from .ini file
+    parser = ConfigParser()
+    parser.read("settings.ini")
+    settings = parser['settings']
+
+    SDE = settings.get("SDE")
+
+    # FEATURES
+    BUILDING_POLYGONS_FEATURE = os.path.join(SDE, "SDEADM.BLD_building_polygon")
+    WASTE_COLLECTION_AREAS_FEATURE = os.path.join(SDE, "SDEADM.ADM_solid_waste", "SDEADM.ADM_waste_coll_area")
+    BUILDING_USE_TABLE = os.path.join(SDE, "SDEADM.BLD_BUILDING_USE")
+
+    logger.setLevel(logging.DEBUG)
+
+    handler = logging.FileHandler(LOG_FILE)
+    handler.setFormatter(FORMATTER)
+    logger.addHandler(handler)
 
 
 def export_report(aggregated_df: pd.DataFrame, raw_df: pd.DataFrame, excel_file=OUTPUT_EXCEL_NAME):
@@ -79,9 +95,15 @@ def export_report(aggregated_df: pd.DataFrame, raw_df: pd.DataFrame, excel_file=
     if len(raw_df.index) > 0:
         arcpy.AddMessage("\nExporting Report to Excel...")
 
-        with pd.ExcelWriter(excel_file) as writer:
+        # xlsxwriter is a much faster writer than the default openpyxl engine
+        with pd.ExcelWriter(excel_file, engine="xlsxwriter") as writer:
             aggregated_df.to_excel(writer, sheet_name="final")
-            raw_df.to_excel(writer, sheet_name="summary")
+
+            # Flatten the COLL_AREA, BL_ID index so ~130k rows aren't written as merged cells.
+            # The BL_ID count column is renamed first so it doesn't clash with the BL_ID index level
+            raw_df.rename(columns={"BL_ID": "BL_ID COUNT"}).reset_index().to_excel(
+                writer, sheet_name="summary", index=False
+            )
 
         logger.debug("Exported to Excel")
         return excel_file
@@ -139,6 +161,8 @@ def dwelling_units():
     :return:
     """
 
+    _configure()
+
     # Create GEODATABASE and Use for as workspace
     working_gdb = arcpy.CreateFileGDB_management(
         out_folder_path=SCRIPT_DIR,
@@ -181,8 +205,6 @@ def dwelling_units():
         fields=[]
     )[0]
 
-    sleep(10)  # Ensure join geoprocessing tool is finished.
-
     # TODO: Export Joined Feature (for debug only)
     arcpy.AddMessage("\tExporting Joined Features...")
     joined_feature = arcpy.FeatureClassToFeatureClass_conversion(
@@ -205,6 +227,7 @@ def dwelling_units():
 
 if __name__ == "__main__":
     arcpy.env.overwriteOutput = True
+    _configure()
 
     try:
         dwelling_units = dwelling_units()
@@ -4,14 +4,13 @@ Run-Time: ~20 minutes
 A. Gallagher
 Outputs: Excel file
 - Important to make sure output excel file has 8 Collection Areas. Sometimes esri geoprocessing tool
-gets stuck and needs to re-run. time.sleep() can help.
+gets stuck and needs to re-run.
 """
 
 import arcpy
 import os
 import logging
 
-from time import sleep
 from datetime import datetime
 from configparser import ConfigParser
 
@@ -22,32 +21,49 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 OUTPUT_EXCEL_NAME = "Building_Dwellings_Summarized_{}.xlsx".format(TODAY)
 
-# Config Settings from .ini file
-parser = ConfigParser()
-parser.read("settings.ini")
-settings = parser['settings']
-
-SDE = settings.get("SDE")
-
-# FEATURES
-BUILDING_POLYGONS_FEATURE = os.path.join(SDE, "SDEADM.BLD_building_polygon")
-WASTE_COLLECTION_AREAS_FEATURE = os.path.join(SDE, "SDEADM.ADM_solid_waste", "SDEADM.ADM_waste_coll_area")
-BUILDING_USE_TABLE = os.path.join(SDE, "SDEADM.BLD_BUILDING_USE")
-
 # Logger Settings
 LOG_FILE = "logs_{}.log".format(TODAY)
 
-logger = logging.getLogger("__name__")
-level = logging.DEBUG
-logger.setLevel(level)
+logger = logging.getLogger(__name__)
 
 FORMATTER = logging.Formatter(
     '%(asctime)s | %(levelname)s | FUNCTION: %(funcName)s | Msgs: %(message)s', datefmt='%d-%b-%y %H:%M:%S'
 )
 
-handler = logging.FileHandler(LOG_FILE)
-handler.setFormatter(FORMATTER)
-logger.addHandler(handler)
+# FEATURES - set from the .ini file by _configure()
+BUILDING_POLYGONS_FEATURE = None
+WASTE_COLLECTION_AREAS_FEATURE = None
+BUILDING_USE_TABLE = None
+
+
+def _configure():
+    """
+    - Read settings from the .ini file and add the log file handler
+    - Called by dwelling_units(), so importing the module has no side effects. Only runs once
+    """
+
+    global BUILDING_POLYGONS_FEATURE, WASTE_COLLECTION_AREAS_FEATURE, BUILDING_USE_TABLE
+
+    if BUILDING_POLYGONS_FEATURE is not None:
+        return
+
+    # Config Settings from .ini file
+    parser = ConfigParser()
+    parser.read("settings.ini")
+    settings = parser['settings']
+
+    SDE = settings.get("SDE")
+
+    # FEATURES
+    BUILDING_POLYGONS_FEATURE = os.path.join(SDE, "SDEADM.BLD_building_polygon")
+    WASTE_COLLECTION_AREAS_FEATURE = os.path.join(SDE, "SDEADM.ADM_solid_waste", "SDEADM.ADM_waste_coll_area")
+    BUILDING_USE_TABLE = os.path.join(SDE, "SDEADM.BLD_BUILDING_USE")
+
+    logger.setLevel(logging.DEBUG)
+
+    handler = logging.FileHandler(LOG_FILE)
+    handler.setFormatter(FORMATTER)
+    logger.addHandler(handler)
 
 
 def report(dwellings_table, working_gdb):
@@ -56,10 +72,17 @@ def report(dwellings_table, working_gdb):
 
     # Update Table to where 'Coll_Area is None' to include dwellings outside a collection areain report
     print("\nUpdating {} with NO COLLECTION AREA zones...".format(dwellings_table))
-    with arcpy.da.UpdateCursor(dwellings_table, "COLL_AREA", "COLL_AREA IS NULL") as cursor:
-        for row in cursor:
-            row[0] = "N/A"
-            cursor.updateRow(row)
+    no_coll_area_view = arcpy.MakeTableView_management(
+        in_table=dwellings_table,
+        out_view="no_coll_area_view",
+        where_clause="COLL_AREA IS NULL"
+    )[0]
+    arcpy.CalculateField_management(
+        in_table=no_coll_area_view,
+        field="COLL_AREA",
+        expression="'N/A'",
+        expression_type="PYTHON3"
+    )
 
     # Get summary of dwelling units per collection area
     summary_fields = [["DWEL_UNITS", "SUM"]]
@@ -70,7 +93,6 @@ def report(dwellings_table, working_gdb):
         statistics_fields=summary_fields,
         case_field=case_fields
     )[0]
-    sleep(5)
 
     print("Filtering results...")
     dwel_units_sql = "SUM_DWEL_UNITS <= 6"
@@ -80,7 +102,6 @@ def report(dwellings_table, working_gdb):
         where_clause=dwel_units_sql,
         invert_where_clause=""
     )
-    sleep(5)
 
     if int(count) < 125000:
         logger.warning("# of records in filtered dwelling units table: {} (Expected ~131k)".format(count))
@@ -107,6 +128,8 @@ def dwelling_units():
     :return:
     """
 
+    _configure()
+
     # Create GEODATABASE and Use for as workspace
     working_gdb = arcpy.CreateFileGDB_management(
         out_folder_path=SCRIPT_DIR,
@@ -149,8 +172,6 @@ def dwelling_units():
         fields=[]
     )[0]
 
-    sleep(10)  # Ensure join geoprocessing tool is finished.
-
     # Export Joined Feature - may need for debug only
     arcpy.AddMessage("\tExporting Joined Features...")
     joined_feature = arcpy.FeatureClassToFeatureClass_conversion(
@@ -173,6 +194,7 @@ def dwelling_units():
 
 if __name__ == "__main__":
     arcpy.env.overwriteOutput = True
+    _configure()
 
     # working_gdb = os.path.join(SCRIPT_DIR, "temp_workspace.gdb")
     # dwelling_units = os.path.join(working_gdb, "buildings_w_waste_areas_blduse")
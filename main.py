@@ -1,9 +1,12 @@
 import arcpy
 import os
 import logging
+import shapely
+import pyogrio
+import numpy as np
 import pandas as pd
+import geopandas as gpd
 
-from time import sleep
 from datetime import datetime
 from configparser import ConfigParser
 
@@ -17,14 +20,8 @@ OUTPUT_EXCEL_NAME = f"Building_Dwellings_Summarized_{TODAY}.xlsx"
 EXCEL_PATH = os.path.join(SCRIPT_DIR, OUTPUT_EXCEL_NAME)
 LOG_FILE = f"logs_{TODAY}.log"
 LOGGING_LEVEL = "debug"
-
-# Config Settings from ini file
-parser = ConfigParser()
-parser.read("settings.ini")
-settings = parser['settings']
-
-WORKING_DIR = settings.get("WORKING_DIR")
-SDE = settings.get("SERVER_SDE")
+DEBUG_DUMP_FRAMES = False  # Write the intermediate DataFrames to parquet files in the working directory
+CACHE_DIR = os.path.join(SCRIPT_DIR, "cache")  # Kept between runs, unlike temp_workspace.gdb
 
 DWEL_UNITS_SQL = "SUM_DWEL_UNITS <= 6 And SUM_DWEL_UNITS <> 0"
 
@@ -40,44 +37,70 @@ levels = {
     "error": logging.ERROR,
     "critical": logging.CRITICAL
 }
-level = levels[LOGGING_LEVEL.lower()]
 
-handler = logging.FileHandler(LOG_FILE)
-handler.setFormatter(FORMATTER)
+logger = logging.getLogger(__name__)
+
+# Set from settings.ini by _configure()
+WORKING_DIR = None
+SDE = None
+
+
+def _configure():
+    """
+    - Read settings from the ini file and add the log file handler
+    - Only called when the script is run, so importing the module has no side effects
+    """
+
+    global WORKING_DIR, SDE
+
+    # Config Settings from ini file
+    parser = ConfigParser()
+    parser.read("settings.ini")
+    settings = parser['settings']
 
-logger = logging.getLogger("__name__")
-logger.setLevel(level)
-logger.addHandler(handler)
+    WORKING_DIR = settings.get("WORKING_DIR")
+    SDE = settings.get("SERVER_SDE")
 
+    handler = logging.FileHandler(LOG_FILE)
+    handler.setFormatter(FORMATTER)
 
-def summarize_units(dwellings_table) -> (pd.DataFrame, pd.DataFrame):
+    logger.setLevel(levels[LOGGING_LEVEL.lower()])
+    logger.addHandler(handler)
+
+
+def summarize_units(dwellings_df: pd.DataFrame) -> (pd.DataFrame, pd.DataFrame):
     """
-    - Convert table to DataFrame and aggregate data by Collection Area, Number of Dwelling Units
-    - Filter out any buildings with more than 6 units
+    - Aggregate data by Collection Area, Number of Dwelling Units
+    - Buildings with more than 6 units in total are already filtered out when the building use table is summarized
     - Append a row to sum number of dwelling units
 
-    :param dwellings_table: Table with BL_ID, DWELLING UNITS, COLLECTION AREA data
+    :param dwellings_df: DataFrame with BL_ID, COLLECTION AREA, DWELLING UNITS and USE_COUNT - one row per building
+        - USE_COUNT is kept in the summary table - the number of building use rows summed for the building
     :return: DataFrames - 1) Raw Data, 2) Aggregated by Collection Area Summary Table
     """
 
     print("\nSummarizing Units...")
-    case_fields = ["COLL_AREA", "BL_ID"]  # First aggregate data by these fields
-    dataframe_columns = ["BL_ID", "COLL_AREA", "DWEL_UNITS"]
-
-    # Convert table to Numpy Array in order to create DataFrame
-    np_array = arcpy.da.FeatureClassToNumPyArray(
-        dwellings_table,
-        field_names=dataframe_columns,  # Set columns of interest
-        null_value={"DWEL_UNITS": 0}  # Translate NULL values to zero
-    )
-    df = pd.DataFrame(np_array)
+    case_fields = ["COLL_AREA", "BL_ID"]
 
-    # Get SUM and COUNT of DWELLING UNITS, BL_IDs
-    print(f"\tGrouping by {', '.join(case_fields)}...")
-    df_summary_one = df.query("DWEL_UNITS <= 6").groupby(case_fields).agg({"DWEL_UNITS": "sum", "BL_ID": "count"})
+    # Dwelling units are already summed per building by Statistics_analysis - just index by the case fields
+    print(f"\tIndexing by {', '.join(case_fields)}...")
+    df_summary_one = dwellings_df.set_index(case_fields).sort_index()
 
     print(f"\tGrouping by COLL_AREA")
-    df_final = df_summary_one.groupby("COLL_AREA").agg({"DWEL_UNITS": "sum", "BL_ID": "count"})
+    area_codes, areas = pd.factorize(df_summary_one.index.get_level_values("COLL_AREA"), sort=True)
+
+    # Drop buildings without a collection area (code -1), as groupby did with NULL keys
+    has_area = area_codes >= 0
+    df_summary_one = df_summary_one[has_area]
+    area_codes = area_codes[has_area]
+
+    df_final = pd.DataFrame(
+        {
+            "DWEL_UNITS": np.bincount(area_codes, weights=df_summary_one["DWEL_UNITS"]).astype(np.int64),
+            "BL_ID": np.bincount(area_codes)
+        },
+        index=pd.Index(np.asarray(areas), name="COLL_AREA")  # Plain labels, so the TOTAL row can be added
+    )
 
     # Add sum row
     df_final.loc["TOTAL"] = df_final.sum()
@@ -90,77 +113,226 @@ def summarize_units(dwellings_table) -> (pd.DataFrame, pd.DataFrame):
 
     print(df_final)
 
-    # Export DataFrames to csv
-    for df_info in (df_final, "df_final.csv"), (df_summary_one, "df_summary.csv"), (df, "df_original.csv"):
-        dataframe, file_name = df_info
-        dataframe.to_csv(file_name, index=False)
+    # Export DataFrames for debugging
+    if DEBUG_DUMP_FRAMES:
+        for df_info in (
+                (df_final, "df_final.parquet"),
+                (df_summary_one, "df_summary.parquet"),
+                (dwellings_df, "df_original.parquet")
+        ):
+            dataframe, file_name = df_info
+            dataframe.to_parquet(file_name)
 
     return df_final, df_summary_one
 
 
-def waste_analysis(workspace, building_polygons, building_use, collection_areas):
+def read_local_features(feature_class, field_names) -> gpd.GeoDataFrame:
+    """
+    - Read a feature class from the local file geodatabase into a GeoDataFrame
+    :param feature_class: Path to the feature class, inside the file geodatabase
+    :param field_names: Attribute fields to read along with the geometry - all other fields are skipped
+    :return: GeoDataFrame
+    """
+
+    # pyogrio reads the whole layer through GDAL's C API instead of feature by feature
+    return pyogrio.read_dataframe(
+        os.path.dirname(feature_class),
+        layer=os.path.basename(feature_class),
+        columns=field_names
+    )
+
+
+def read_sde_features(feature_class, field_names) -> gpd.GeoDataFrame:
+    """
+    - Read features straight from SDE into a GeoDataFrame, without copying them to disk first
+    :param feature_class: Path to the SDE feature class
+    :param field_names: Attribute fields to read along with the geometry
+    :return: GeoDataFrame
     """
-    The waste_analysis function performs the following tasks:
-        1. Dissolves building polygons by BL_ID
-        2. Spatially joins dissolved building polygons with waste collection areas (one-to-one)
-        3. Joins Building Use table to spatially joined feature class (building polygon and waste area) on BL_ID field
+
+    spatial_reference = arcpy.Describe(feature_class).spatialReference
+
+    with arcpy.da.SearchCursor(feature_class, field_names + ["SHAPE@WKB"]) as cursor:
+        df = pd.DataFrame(list(cursor), columns=field_names + ["SHAPE@WKB"])
+
+    return gpd.GeoDataFrame(
+        df[field_names],
+        geometry=gpd.GeoSeries.from_wkb(df["SHAPE@WKB"].map(bytes)),  # Cursor returns bytearray, shapely needs bytes
+        crs=spatial_reference.factoryCode or spatial_reference.exportToString()  # WKT if there's no EPSG code
+    )
+
+
+def source_signature(feature_class) -> str:
+    """
+    - Describe the current state of a feature class by its row count and latest add/modify dates
+    - Falls back to the row count only if the feature class has no ADDDATE/MODDATE fields
+    :param feature_class: Feature class to check, ex. the SDE building polygons
+    :return: Signature string - changes whenever features are added, modified or deleted
+    """
+
+    field_names = {field.name.upper() for field in arcpy.ListFields(feature_class)}
+    date_fields = [field for field in ("ADDDATE", "MODDATE") if field in field_names]
+
+    if not date_fields:
+        logger.warning(f"No ADDDATE/MODDATE fields in {feature_class} - cache only checks the row count")
+        return str(arcpy.GetCount_management(feature_class)[0])
+
+    stats_table = arcpy.Statistics_analysis(
+        in_table=feature_class,
+        out_table=r"memory\source_signature",
+        statistics_fields=[[field, "MAX"] for field in date_fields]
+    )[0]
+
+    with arcpy.da.SearchCursor(stats_table, ["FREQUENCY"] + [f"MAX_{field}" for field in date_fields]) as cursor:
+        signature = next(cursor)
+
+    return "_".join(str(value) for value in signature)
+
+
+def read_cache(name, signature):
+    """
+    - Load a cached GeoDataFrame, if it was built from a source with the same signature
+    :param name: Name of the cached data
+    :param signature: Current signature of the source, from source_signature
+    :return: GeoDataFrame, or None if there is no cache or it is out of date
+    """
+
+    cache_file = os.path.join(CACHE_DIR, f"{name}.parquet")
+    signature_file = os.path.join(CACHE_DIR, f"{name}.signature")
+
+    if not os.path.exists(cache_file) or not os.path.exists(signature_file):
+        return None
+
+    with open(signature_file) as f:
+        if f.read() != signature:
+            return None
+
+    return gpd.read_parquet(cache_file)
+
+
+def write_cache(gdf: gpd.GeoDataFrame, name, signature):
+    """
+    - Cache a GeoDataFrame along with the signature of the source it was built from
+    :param gdf: GeoDataFrame to cache
+    :param name: Name of the cached data
+    :param signature: Current signature of the source, from source_signature
+    """
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    gdf.to_parquet(os.path.join(CACHE_DIR, f"{name}.parquet"))
+
+    with open(os.path.join(CACHE_DIR, f"{name}.signature"), "w") as f:
+        f.write(signature)
+
+
+def building_points(building_polygons) -> gpd.GeoDataFrame:
+    """
+    - Reduce building polygons to one point per BL_ID (in memory with GeoPandas)
+    - The spatial join only needs to know which collection area a building is in, so a point inside
+      the building (like FeatureToPoint "INSIDE") replaces dissolving the polygons by BL_ID
+    :param building_polygons: Building polygons feature class, in the local file geodatabase
+    :return: GeoDataFrame with one point per BL_ID
+    """
+
+    print("\nCreating Building Points...")
+    logger.debug("\nCreating Building Points...")
+    buildings_gdf = read_local_features(building_polygons, ["BL_ID"])
+
+    points_gdf = gpd.GeoDataFrame(buildings_gdf[["BL_ID"]], geometry=buildings_gdf.representative_point())
+
+    return points_gdf.drop_duplicates(subset="BL_ID")  # Buildings with several polygons keep the first one
+
+
+def join_collection_areas(buildings_gdf: gpd.GeoDataFrame, waste_gdf: gpd.GeoDataFrame) -> pd.DataFrame:
+    """
+    - Find the collection area each building is in (one-to-one, buildings outside all areas are dropped)
+    :param buildings_gdf: GeoDataFrame of building points with BL_ID column
+    :param waste_gdf: GeoDataFrame of waste collection areas with COLL_AREA column
+    :return: DataFrame with BL_ID, COLL_AREA columns
+    """
+
+    # The point in polygon tests compare raw coordinates, so both layers have to be in the same coordinate system
+    if waste_gdf.crs != buildings_gdf.crs:
+        if waste_gdf.crs is None or buildings_gdf.crs is None:
+            raise ValueError(
+                f"Can't compare coordinate systems of waste collection areas ({waste_gdf.crs}) "
+                f"and building points ({buildings_gdf.crs})"
+            )
+
+        logger.debug(f"Projecting waste collection areas from {waste_gdf.crs} to {buildings_gdf.crs}")
+        waste_gdf = waste_gdf.to_crs(buildings_gdf.crs)
+
+    # The few collection areas are tested against every building - prepare them once
+    waste_geometries = np.asarray(waste_gdf.geometry)
+    shapely.prepare(waste_geometries)
+
+    # Building points as plain coordinate arrays
+    x = buildings_gdf.geometry.x.to_numpy()
+    y = buildings_gdf.geometry.y.to_numpy()
+
+    # Index of the collection area each building is in, -1 until it is matched
+    area_idx = np.full(len(x), -1)
+
+    for i, waste_geometry in enumerate(waste_geometries):
+        # Only test buildings that haven't matched yet - the first collection area wins (JOIN_ONE_TO_ONE)
+        unmatched = np.flatnonzero(area_idx == -1)
+        in_area = shapely.intersects_xy(waste_geometry, x[unmatched], y[unmatched])  # Keeps boundary points
+        area_idx[unmatched[in_area]] = i
+
+    matched = area_idx >= 0
+    buildings_waste_areas = pd.DataFrame({
+        "BL_ID": buildings_gdf["BL_ID"].to_numpy()[matched],
+        "COLL_AREA": waste_gdf["COLL_AREA"].to_numpy()[area_idx[matched]]
+    })
+
+    # Only a handful of collection areas - group on small integer codes instead of hashing strings
+    buildings_waste_areas["COLL_AREA"] = buildings_waste_areas["COLL_AREA"].astype("category")
+
+    return buildings_waste_areas
+
+
+def waste_analysis(buildings, building_use, waste_areas) -> pd.DataFrame:
+    """
+    The waste_analysis function performs the following tasks (in memory with GeoPandas):
+        1. Spatially joins building points with waste collection areas (one-to-one)
+        2. Joins Building Use table to spatially joined buildings (building polygon and waste area) on BL_ID field
             - This is done to get the number of dwelling units per building, which is needed for calculating
               total number of dwelling units in each collection area
 
-    :param workspace: Set the workspace for the script
-    :param building_polygons: Dissolve the building polygons
-    :param building_use: Join the building use table to the building polygons
-    :param collection_areas: Spatially join the building polygons with the waste collection areas
-    """
-
-    # DISSOLVE BUILDING POLYGONS
-    print("\nDissolving Building Polygons...")
-    logger.debug("\nDissolving Building Polygons...")
-    dissolved_building_polygons = arcpy.Dissolve_management(
-        in_features=building_polygons,
-        out_feature_class=os.path.join(workspace, "dissolved_building_polygons"),
-        dissolve_field=["BL_ID"],
-        statistics_fields=[],
-        multi_part="MULTI_PART",
-        unsplit_lines="DISSOLVE_LINES"
-    )[0]
+    :param buildings: One point per BL_ID, from building_points
+    :param building_use: Join the building use table (SDE) to the building polygons
+    :param waste_areas: GeoDataFrame of waste collection areas to spatially join with the building polygons
+    :return: DataFrame with BL_ID, COLL_AREA, DWEL_UNITS (sum per building), USE_COUNT columns
+    """
 
-    # SPATIAL JOIN DISSOLVED BUILDING POLYGONS WITH WASTE COLLECTION AREAS
-    print("\nSpatially Joining Building Polygons and Waste Collection Areas...")
-    logger.debug("\nSpatially Joining Building Polygons and Waste Collection Areas...")
-    buildings_waste_areas = arcpy.SpatialJoin_analysis(
-        target_features=dissolved_building_polygons,
-        join_features=collection_areas,
-        out_feature_class=os.path.join(workspace, "buildings_w_waste_areas"),
-        join_operation="JOIN_ONE_TO_ONE",
-        join_type="KEEP_ALL",
-        match_option="INTERSECT",
-        search_radius="",
-        distance_field_name=""
-    )[0]
+    # SPATIAL JOIN BUILDING POINTS WITH WASTE COLLECTION AREAS
+    print("\nSpatially Joining Building Points and Waste Collection Areas...")
+    logger.debug("\nSpatially Joining Building Points and Waste Collection Areas...")
+    buildings_waste_areas = join_collection_areas(buildings, waste_areas)
 
     # JOIN BUILDING USE TABLE TO BUILDING POLYGONS
+    # Sum the dwelling units of all uses per BL_ID in the geodatabase - only one row per building comes back.
+    # Every use of a building counts (JoinField_management used to take only the first matching use row),
+    # so DWEL_UNITS is the building total and USE_COUNT (its own column in the summary sheet) is its number of use rows
     print("\nJoining Building Use Table to Building Polygons...")
-    building_polygons_w_bld_use = arcpy.JoinField_management(
-        in_data=buildings_waste_areas,
-        in_field="BL_ID",
-        join_table=building_use,
-        join_field="BL_ID",
-        fields=[]
-    )[0]
-
-    sleep(10)
-
-    # TODO: Export Joined Feature (for debug only)
-    print("\tExporting Joined Features...")
-    joined_feature = arcpy.FeatureClassToFeatureClass_conversion(
-        in_features=building_polygons_w_bld_use,
-        out_path=workspace,
-        out_name="buildings_w_waste_areas_blduse",
-        where_clause="Join_Count > 0"  # Dwel Units <=6
+    bld_use_stats = arcpy.Statistics_analysis(
+        in_table=building_use,
+        out_table=r"memory\bld_use_stats",
+        statistics_fields=[["DWEL_UNITS", "SUM"], ["BL_ID", "COUNT"]],
+        case_field=["BL_ID"]
     )[0]
+    bld_use_df = pd.DataFrame(
+        arcpy.da.TableToNumPyArray(
+            bld_use_stats,
+            field_names=["BL_ID", "SUM_DWEL_UNITS", "COUNT_BL_ID"],  # Explicit fields - no OID column is added
+            where_clause="SUM_DWEL_UNITS <= 6 OR SUM_DWEL_UNITS IS NULL",  # Filter out buildings with more than 6 units
+            null_value={"SUM_DWEL_UNITS": 0}  # Translate NULL values to zero
+        )
+    ).rename(columns={"SUM_DWEL_UNITS": "DWEL_UNITS", "COUNT_BL_ID": "USE_COUNT"})
+    bld_use_df["DWEL_UNITS"] = bld_use_df["DWEL_UNITS"].astype(np.int64)  # Statistics SUM is a double field
+    joined_df = buildings_waste_areas.merge(bld_use_df, on="BL_ID", how="inner")
 
-    joined_records_count = int(arcpy.GetCount_management(joined_feature)[0])
+    joined_records_count = len(buildings_waste_areas.index)
     print(f"\tNumber of Joined Records: {joined_records_count}. (Should be >100k)")
 
     if joined_records_count < 100000:
@@ -168,10 +340,59 @@ def waste_analysis(workspace, building_polygons, building_use, collection_areas)
     else:
         logger.debug(f"\tNumber of Joined Records: {joined_records_count}. (Should be >100k)")
 
-    return joined_feature
+    return joined_df
+
+
+def analyze_in_memory(bld_poly_path, bld_use_path, waste_path, workspace) -> (pd.DataFrame, pd.DataFrame):
+    """
+    - Run the whole analysis in memory: building points, spatial join with the waste collection areas,
+      building use, summary by collection area
+    - arcpy only reads from SDE, and copies the building polygons for GeoPandas when the cached points are stale
+
+    :param bld_poly_path: Building polygons feature class (SDE)
+    :param bld_use_path: Building use table (SDE)
+    :param waste_path: Waste collection areas feature class (SDE)
+    :param workspace: File geodatabase to copy the building polygons to
+    :return: DataFrames - 1) Aggregated by Collection Area Summary Table, 2) Raw Data
+    """
+
+    # Building points are cached between runs and only rebuilt when the building polygons have changed
+    bld_poly_signature = source_signature(bld_poly_path)
+    bld_points = read_cache("building_points", bld_poly_signature)
+
+    if bld_points is not None:
+        logger.info("Using cached building points")
+
+    # Only the building polygons are copied to the file gdb, for GeoPandas (GDAL) to read.
+    # The waste collection areas are read straight into memory and the building use table
+    # is read from SDE in waste_analysis, so neither touches disk.
+    # arcpy isn't thread-safe, so the SDE reads run one after the other
+    waste_areas = read_sde_features(waste_path, ["COLL_AREA"])
+
+    if bld_points is None:
+        bld_poly_copy = arcpy.FeatureClassToFeatureClass_conversion(
+            in_features=bld_poly_path,
+            out_path=workspace,
+            out_name='BLD_building_polygon'
+        )[0]
+        bld_points = building_points(bld_poly_copy)
+        write_cache(bld_points, "building_points", bld_poly_signature)
+
+    waste_building_units = waste_analysis(
+        buildings=bld_points,
+        building_use=bld_use_path,
+        waste_areas=waste_areas
+    )
+
+    # SUMMARIZE ATTRIBUTES BY BL_ID, COLLECTION_AREA ON DWELLING UNITS
+    print("\nSummarizing Attributes...")
+    logger.debug("\nSummarizing Attributes...")
+
+    return summarize_units(dwellings_df=waste_building_units)
 
 
 if __name__ == "__main__":
+    _configure()
 
     # FEATURES
     BUILDING_POLYGONS_FEATURE = os.path.join(SDE, "SDEADM.BLD_building_polygon")
@@ -186,37 +407,14 @@ if __name__ == "__main__":
         out_name="temp_workspace.gdb"
     )[0]  # This will overwrite any existing gdb, clearing any existing feature classes
 
-    # Local features
-    local_bld_poly = arcpy.FeatureClassToFeatureClass_conversion(
-        in_features=BUILDING_POLYGONS_FEATURE,
-        out_path=working_gdb,
-        out_name='BLD_building_polygon'
-    )[0]
-    local_bld_use = arcpy.TableToTable_conversion(
-        in_rows=BUILDING_USE_TABLE,
-        out_path=working_gdb,
-        out_name='BLD_BUILDING_USE'
-    )[0]
-    local_waste_areas = arcpy.FeatureClassToFeatureClass_conversion(
-        in_features=WASTE_COLLECTION_AREAS_FEATURE,
-        out_path=working_gdb,
-        out_name='ADM_waste_coll_area'
-    )[0]
-
     try:
-        waste_building_units = waste_analysis(
-            workspace=working_gdb,
-            building_polygons=local_bld_poly,
-            building_use=local_bld_use,
-            collection_areas=local_waste_areas
+        df_final, df_summarized = analyze_in_memory(
+            bld_poly_path=BUILDING_POLYGONS_FEATURE,
+            bld_use_path=BUILDING_USE_TABLE,
+            waste_path=WASTE_COLLECTION_AREAS_FEATURE,
+            workspace=working_gdb
         )
 
-        # SUMMARIZE ATTRIBUTES BY BL_ID, COLLECTION_AREA ON DWELLING UNITS
-        print("\nSummarizing Attributes...")
-        logger.debug("\nSummarizing Attributes...")
-
-        df_final, df_summarized = summarize_units(dwellings_table=waste_building_units)
-
         summary_rows = len(df_summarized.index)
         area_1_units = df_final.loc["AREA 1", "SUM of DWELLING UNITS"]
 
@@ -237,9 +435,12 @@ if __name__ == "__main__":
         if len(df_summarized.index) > 0:
             print("\nExporting Report to Excel...")
 
-            with pd.ExcelWriter(OUTPUT_EXCEL_NAME) as writer:
+            # xlsxwriter is a much faster writer than the default openpyxl engine
+            with pd.ExcelWriter(OUTPUT_EXCEL_NAME, engine="xlsxwriter") as writer:
                 df_final.to_excel(writer, sheet_name="final")
-                df_summarized.to_excel(writer, sheet_name="summary")
+
+                # Flatten the COLL_AREA, BL_ID index so ~130k rows aren't written as merged cells
+                df_summarized.reset_index().to_excel(writer, sheet_name="summary", index=False)
 
             logger.debug("\nExported to Excel")
 